@@ -0,0 +1,6 @@
+# Root conftest: puts the repo root on sys.path so tests can import etl_api_runner,
+# and gives the module the settings it needs at import time.
+import os
+
+os.environ.setdefault("MONGO_DB", "test")
+os.environ.setdefault("SPACES_REGION", "nyc3")
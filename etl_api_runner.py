@@ -2,11 +2,23 @@ import os
 import csv
 import io
 import time
+import queue
+from functools import wraps
 import psutil
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from collections import defaultdict
+from contextlib import suppress
+from dataclasses import dataclass, field
+from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread, Lock
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError
 from dotenv import load_dotenv
 import boto3
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
 from flask import Flask, jsonify
 
 # -----------------------------
@@ -24,9 +36,21 @@ SPACES_REGION = os.getenv("SPACES_REGION")
 SPACES_BUCKET = os.getenv("SPACES_BUCKET")
 SPACES_PREFIX = os.getenv("SPACES_PREFIX", "")
 
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "100"))
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "8"))  # files processed in parallel
+# w=0 skips the server ack per batch; only safe for fresh loads that can be re-run,
+# and inserted counts then report rows sent rather than rows actually upserted
+UNACKNOWLEDGED_WRITES = os.getenv("UNACKNOWLEDGED_WRITES", "false").lower() == "true"
+QUEUE_DEPTH = 4  # parsed batches buffered between download and insert
+CHUNK_SIZE = 16 * 1024 * 1024  # bytes per multipart GET / read buffer
+PARSE_BLOCK_SIZE = 8 * 1024 * 1024  # bytes parsed per pyarrow record batch
+PROGRESS_EVERY = 64 * 1024 * 1024  # print download progress every 64 MB
+TRANSFER_CONCURRENCY = 8  # multipart GETs in flight per file
+
 # -----------------------------
 # Mongo + Spaces
 # -----------------------------
+# Both clients are thread-safe and shared by all file workers.
 client = MongoClient(MONGO_URI)
 db = client[MONGO_DB]
 
@@ -35,131 +59,351 @@ s3 = boto3.client(
     region_name=SPACES_REGION,
     endpoint_url=f"https://{SPACES_REGION}.digitaloceanspaces.com",
     aws_access_key_id=SPACES_KEY,
-    aws_secret_access_key=SPACES_SECRET
+    aws_secret_access_key=SPACES_SECRET,
+    config=Config(
+        # every file worker can have TRANSFER_CONCURRENCY GETs in flight
+        max_pool_connections=MAX_WORKERS * TRANSFER_CONCURRENCY,
+        retries={"max_attempts": 10, "mode": "adaptive"},
+        tcp_keepalive=True
+    )
+)
+
+transfer_config = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=CHUNK_SIZE,
+    max_concurrency=TRANSFER_CONCURRENCY,
+    use_threads=True
 )
 
 # -----------------------------
 # Global State
 # -----------------------------
-inserted_count = 0
-total_count = 0
-job_running = False
-lock = Lock()
-start_time = None
+@dataclass
+class FileCounter:
+    inserted: int = 0
+    total: int = 0
+
+
+@dataclass
+class JobStats:
+    """Job progress; each file worker owns one FileCounter and `/stats` sums them on read."""
+
+    running: bool = False
+    start_time: Optional[float] = None
+    files: dict = field(default_factory=dict)
+
+    def counter(self, key):
+        # single writer per counter, so workers never need a lock to update it
+        counter = self.files[key] = FileCounter()
+        return counter
+
+    @property
+    def inserted(self):
+        return sum(c.inserted for c in list(self.files.values()))
+
+    @property
+    def total(self):
+        return sum(c.total for c in list(self.files.values()))
+
+
+current_job = JobStats()  # the job /stats and /stop act on
+job_thread = None
+start_lock = Lock()  # /start runs on gunicorn threads; check-and-launch must be atomic
+collections = {}  # collection name -> handle, or the create_index error, for this job
+collection_locks = defaultdict(Lock)  # one per collection name, held while its index is built
+collections_lock = Lock()  # guards collection_locks
 
 # -----------------------------
 # Download with Progress
 # -----------------------------
+class DownloadProgress:
+    """`download_fileobj` callback; transfer threads report bytes concurrently."""
+
+    def __init__(self, filename, total_size):
+        self.filename = filename
+        self.total_size = total_size
+        self.downloaded = 0
+        self.lock = Lock()
+
+    def __call__(self, bytes_amount):
+        with self.lock:
+            previous = self.downloaded
+            self.downloaded += bytes_amount
+            if self.downloaded // PROGRESS_EVERY > previous // PROGRESS_EVERY:
+                percent = (self.downloaded / self.total_size) * 100
+                print(f"   {self.downloaded/1024:.2f} KB / {self.total_size/1024:.2f} KB ({percent:.2f}%)", end="\r")
+
+
+class PipeReader(io.FileIO):
+    """Read end of the pipe a background download writes into.
+
+    A failed download surfaces as an exception at EOF instead of a silently
+    truncated CSV.
+    """
+
+    error = None
+
+    def readinto(self, b):
+        n = super().readinto(b)
+        if n == 0 and self.error:
+            raise self.error
+        return n
+
+
 def download_with_progress(bucket, key, filename):
     try:
         obj = s3.head_object(Bucket=bucket, Key=key)
         total_size = obj['ContentLength']
         print(f"\n⬇️ Downloading {filename} ({total_size/1024:.2f} KB)...")
+    except Exception as e:
+        print(f"❌ Failed to download {filename}: {e}")
+        return None
 
-        response = s3.get_object(Bucket=bucket, Key=key)
-        body = response['Body']
-
-        chunk_size = 1024 * 1024  # 1 MB
-        downloaded = 0
-        buffer = io.BytesIO()
+    if total_size == 0:  # nothing to insert; pyarrow rejects empty input outright
+        print(f"⚠️ {filename} is empty, nothing to insert")
+        return None
 
-        while True:
-            data = body.read(chunk_size)
-            if not data:
-                break
-            buffer.write(data)
-            downloaded += len(data)
-            percent = (downloaded / total_size) * 100
-            print(f"   {downloaded/1024:.2f} KB / {total_size/1024:.2f} KB ({percent:.2f}%)", end="\r")
+    # s3transfer runs the multipart GETs and writes parts in order into the pipe,
+    # which the CSV parser consumes from the read end as data arrives
+    read_fd, write_fd = os.pipe()
+    reader = PipeReader(read_fd, "r")
 
-        print(f"\n✅ Finished downloading {filename}")
-        buffer.seek(0)
-        return buffer
+    def download():
+        sink = open(write_fd, "wb")
+        try:
+            s3.download_fileobj(bucket, key, sink, Config=transfer_config,
+                                Callback=DownloadProgress(filename, total_size))
+            print(f"\n✅ Finished downloading {filename}")
+        except BrokenPipeError:
+            pass  # the parser closed the read end (/stop or a parse error) and wants no more data
+        except Exception as e:
+            print(f"❌ Failed to download {filename}: {e}")
+            reader.error = e
+        finally:
+            with suppress(BrokenPipeError):  # flushing leftovers into a closed pipe
+                sink.close()
 
-    except Exception as e:
-        print(f"❌ Failed to download {filename}: {e}")
-        return None
+    Thread(target=download, daemon=True).start()
+    return io.BufferedReader(reader, CHUNK_SIZE)
 
 # -----------------------------
 # Insert CSV Stream (Improved)
 # -----------------------------
-def insert_csv_from_stream(stream, collection_name):
-    global inserted_count, total_count
-    collection = db[collection_name]
+def _parse_batches(stream, collection_name, batches, job):
+    """Producer: parse CSV rows from `stream` and queue them in BATCH_SIZE upsert batches."""
+    # columns are positional (no header row); fixing the names means the first row
+    # does not decide the column count for the rest of the file
+    read_options = pacsv.ReadOptions(block_size=PARSE_BLOCK_SIZE, column_names=["url_id", "input_url"])
+    convert_options = pacsv.ConvertOptions(column_types={"url_id": pa.string(), "input_url": pa.string()})
+
+    # rows with a field count other than two are re-parsed here, keeping the first two
+    # fields like csv.reader did; called from pyarrow's parser threads. Keyed by row
+    # number (None for rows without two fields) so they can be merged back in file order.
+    recovered = {}
+
+    def recover_row(row):
+        fields = next(csv.reader([row.text]), [])
+        if len(fields) >= 2:
+            recovered[row.number] = (fields[0], fields[1])
+        else:
+            print(f"⚠️ Skipping malformed row {row.number}: {fields}")
+            recovered[row.number] = None
+        return "skip"
+
+    parse_options = pacsv.ParseOptions(invalid_row_handler=recover_row)
+
+    ops = []
+    seen = set()  # url_ids already queued from this file
+    seen_add = seen.add
+    duplicates = 0
+    row_number = 0  # last row (in file order) handed to queue_rows
+
+    def in_file_order(rows):
+        """Interleave recovered ragged rows with a record batch's rows by row number."""
+        nonlocal row_number
+        merged = []
+        for row in rows:
+            row_number += 1
+            while row_number in recovered:
+                ragged = recovered.pop(row_number)
+                if ragged:
+                    merged.append(ragged)
+                row_number += 1
+            merged.append(row)
+        while row_number + 1 in recovered:
+            row_number += 1
+            ragged = recovered.pop(row_number)
+            if ragged:
+                merged.append(ragged)
+        return merged
+
+    def queue_rows(rows):
+        nonlocal ops, duplicates
+        # an upsert copies url_id from the filter, so only the remaining fields are sent
+        new_ops = [
+            UpdateOne({"url_id": url_id}, {"$setOnInsert": {"input_url": url, "status": "pending"}}, upsert=True)
+            for url_id, url in rows
+            if url_id not in seen and not seen_add(url_id)
+        ]
+        duplicates += len(rows) - len(new_ops)
+
+        ops.extend(new_ops)
+        full = len(ops) - len(ops) % BATCH_SIZE
+        for start in range(0, full, BATCH_SIZE):
+            batches.put(ops[start:start + BATCH_SIZE])
+        ops = ops[full:]
 
     try:
-        reader = csv.reader(io.StringIO(stream.read().decode("utf-8")))
-        rows = list(reader)
+        reader = pacsv.open_csv(stream, read_options=read_options,
+                                parse_options=parse_options, convert_options=convert_options)
+        for record_batch in reader:
+            if not job.running:  # /stop: abandon the rest of the file
+                break
+            queue_rows(in_file_order(zip(record_batch.column(0).to_pylist(), record_batch.column(1).to_pylist())))
+        else:
+            # ragged rows after the last valid row
+            queue_rows([recovered[n] for n in sorted(recovered) if recovered[n]])
     except Exception as e:
         print(f"❌ Failed to read CSV stream for {collection_name}: {e}")
+    finally:
+        if duplicates:
+            print(f"⚠️ Skipped {duplicates} duplicate url_ids within `{collection_name}` file")
+        if ops:
+            batches.put(ops)
+        batches.put(None)
+        stream.close()
+
+
+def _get_collection(collection_name):
+    """Collection handle with its unique url_id index ensured, created once per job.
+
+    A failed index build is remembered and re-raised, so files sharing the
+    collection do not each retry it.
+    """
+    if collection_name not in collections:
+        with collections_lock:
+            name_lock = collection_locks[collection_name]
+        # only workers for this collection wait while its index is built
+        with name_lock:
+            if collection_name not in collections:
+                collection = db[collection_name]
+                try:
+                    # unique index lets the server handle duplicate url_ids (idempotent)
+                    collection.create_index("url_id", unique=True)
+                    collections[collection_name] = collection
+                except Exception as e:
+                    collections[collection_name] = e
+    cached = collections[collection_name]
+    if isinstance(cached, Exception):
+        raise cached
+    return cached
+
+
+def insert_csv_from_stream(stream, collection_name, job, counter):
+    try:
+        collection = _get_collection(collection_name)
+    except Exception as e:
+        print(f"❌ Failed to create url_id index on `{collection_name}`: {e}")
+        stream.close()
         return
 
-    total_count += len(rows)
-    print(f"📥 Starting insert for `{collection_name}` → {len(rows)} rows")
+    if UNACKNOWLEDGED_WRITES:
+        collection = collection.with_options(write_concern=WriteConcern(w=0))
 
-    for i, row in enumerate(rows, start=1):
-        if len(row) < 2:
-            print(f"⚠️ Skipping malformed row {i}: {row}")
-            continue
+    print(f"📥 Starting insert for `{collection_name}`")
 
-        doc = {"url_id": row[0], "input_url": row[1], "status": "pending"}
+    # producer parses the download into batches while this thread writes them to Mongo
+    batches = queue.Queue(maxsize=QUEUE_DEPTH)
+    Thread(target=_parse_batches, args=(stream, collection_name, batches, job), daemon=True).start()
+
+    while True:
+        ops = batches.get()
+        if ops is None:
+            break
+        if not job.running:
+            continue  # drain until the producer notices /stop and ends the queue
 
         try:
-            # avoid duplicates
-            if not collection.find_one({"url_id": doc["url_id"]}):
-                collection.insert_one(doc)
-                with lock:
-                    inserted_count += 1
-            else:
-                print(f"⚠️ Skipped duplicate url_id {doc['url_id']}")
+            # upsert + $setOnInsert: existing url_ids are left untouched
+            result = collection.bulk_write(ops, ordered=False)
+            upserted = result.upserted_count if result.acknowledged else len(ops)
+        except BulkWriteError as e:
+            # concurrent upserts of the same url_id surface as E11000 dup errors; anything else is a real failure
+            upserted = e.details.get("nUpserted", 0)
+            failed = [err for err in e.details.get("writeErrors", []) if err.get("code") != 11000]
+            if failed:
+                print(f"❌ {len(failed)} rows failed to write to `{collection_name}`: {failed[0].get('errmsg')}")
         except Exception as e:
-            print(f"❌ Error inserting row {i} in `{collection_name}`: {e}")
+            print(f"❌ Error writing batch of {len(ops)} rows to `{collection_name}`: {e}")
+            upserted = 0
+
+        counter.inserted += upserted
+        counter.total += len(ops)
 
-        if i % 1000 == 0:  # progress every 1000 rows
-            print(f"✅ Inserted {i}/{len(rows)} rows into `{collection_name}`")
+        if counter.total // 1000 > (counter.total - len(ops)) // 1000:  # progress every 1000 rows
+            print(f"✅ Inserted {counter.total} rows into `{collection_name}`")
 
-    print(f"🎯 Finished `{collection_name}` → {inserted_count}/{total_count} total inserted\n")
+    print(f"🎯 Finished `{collection_name}` → {counter.inserted}/{counter.total} inserted\n")
 
 # -----------------------------
 # ETL Process (Improved)
 # -----------------------------
-def process_all_csv_from_spaces():
-    global job_running, start_time
-    job_running = True
-    start_time = time.time()
+def _process_one(job, key, filename, collection_name):
+    if not job.running:
+        return
+
+    print(f"\n📤 Processing `{filename}` → inserting into `{collection_name}`")
+
+    buffer = download_with_progress(SPACES_BUCKET, key, filename)
+    if buffer:
+        try:
+            insert_csv_from_stream(buffer, collection_name, job, job.counter(key))
+        except Exception as e:
+            print(f"❌ Critical error while processing `{filename}`: {e}")
+
+
+def _list_csv_files():
+    """Yield (key, filename, collection_name) for every CSV under the prefix."""
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=SPACES_BUCKET, Prefix=SPACES_PREFIX):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            if key.endswith(".csv"):
+                filename = os.path.basename(key)
+                collection_name = os.path.splitext(filename)[0] if MODE == "per_file" else FIXED_COLLECTION
+                yield key, filename, collection_name
+
+
+def process_all_csv_from_spaces(job=None):
+    if job is None:
+        job = JobStats(running=True, start_time=time.time())
+    collections.clear()  # re-ensure indexes in case collections were dropped between runs
 
     print(f"\n📦 Scanning bucket `{SPACES_BUCKET}` under prefix `{SPACES_PREFIX}`...\n")
+    file_count = 0
     try:
-        objects = s3.list_objects_v2(Bucket=SPACES_BUCKET, Prefix=SPACES_PREFIX)
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # files are dispatched page by page, so workers start while listing continues
+            for key, filename, collection_name in _list_csv_files():
+                if not job.running:
+                    break
+                file_count += 1
+                executor.submit(_process_one, job, key, filename, collection_name)
     except Exception as e:
         print(f"❌ Failed to list objects in bucket: {e}")
-        job_running = False
-        return
 
-    if 'Contents' not in objects:
+    if file_count:
+        print(f"📂 Processed {file_count} CSV files")
+    else:
         print("⚠️ No CSV files found in bucket.")
-        job_running = False
-        return
-
-    csv_files = [obj["Key"] for obj in objects["Contents"] if obj["Key"].endswith(".csv")]
-    print(f"📂 Found {len(csv_files)} CSV files\n")
-
-    for key in csv_files:
-        filename = os.path.basename(key)
-        collection_name = os.path.splitext(filename)[0] if MODE == "per_file" else FIXED_COLLECTION
 
-        print(f"\n📤 Processing `{filename}` → inserting into `{collection_name}`")
-
-        buffer = download_with_progress(SPACES_BUCKET, key, filename)
-        if buffer:
-            try:
-                insert_csv_from_stream(buffer, collection_name)
-            except Exception as e:
-                print(f"❌ Critical error while processing `{filename}`: {e}")
-
-    job_running = False
-    duration = int(time.time() - start_time)
-    print(f"\n🎯 All uploads complete in {duration}s. Total inserted: {inserted_count}/{total_count}")
+    stopped = not job.running
+    job.running = False
+    duration = int(time.time() - job.start_time)
+    if stopped:
+        print(f"\n🛑 Job stopped after {duration}s. Total inserted: {job.inserted}/{job.total}")
+    else:
+        print(f"\n🎯 All uploads complete in {duration}s. Total inserted: {job.inserted}/{job.total}")
 
 # -----------------------------
 # Flask API for control + stats
@@ -168,31 +412,26 @@ app = Flask(__name__)
 
 @app.route("/start")
 def start_job():
-    global job_running
-    if job_running:
-        return {"status": "⚠️ Job already running"}
-    t = Thread(target=process_all_csv_from_spaces)
-    t.start()
+    global current_job, job_thread
+    with start_lock:
+        if current_job.running:
+            return {"status": "⚠️ Job already running"}
+        if job_thread and job_thread.is_alive():
+            return {"status": "⚠️ Previous job is still stopping"}
+        # bind the new job before the thread starts so an immediate /stop reaches it
+        current_job = JobStats(running=True, start_time=time.time())
+        job_thread = Thread(target=process_all_csv_from_spaces, args=(current_job,))
+        job_thread.start()
     return {"status": "🚀 Job started"}
 
 @app.route("/stop")
 def stop_job():
-    global job_running
-    job_running = False
-    return {"status": "🛑 Stop signal sent (will finish current file)"}
-
+    current_job.running = False
+    return {"status": "🛑 Stop signal sent (will stop after the current batch)"}
 
-@app.route("/stats")
-def stats():
-    cpu = psutil.cpu_percent(interval=0.5)
-    mem = psutil.virtual_memory()
-    uptime = int(time.time() - start_time) if start_time else 0
 
-    progress = f"{(inserted_count/total_count*100):.2f}%" if total_count else "0%"
-    healthy = cpu < 80 and mem.percent < 80
-
-    # ✅ Mobile-friendly HTML with inline CSS
-    html = f"""
+# ✅ Mobile-friendly HTML with inline CSS, built once at import
+STATS_TEMPLATE = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -226,21 +465,68 @@ def stats():
     <body>
       <h2>📊 Job Stats</h2>
       <table>
-        <tr><th>Inserted</th><td>{inserted_count}</td></tr>
-        <tr><th>Total</th><td>{total_count}</td></tr>
+        <tr><th>Inserted</th><td>{inserted}</td></tr>
+        <tr><th>Total</th><td>{total}</td></tr>
         <tr><th>Progress</th><td>{progress}</td></tr>
         <tr><th>CPU Usage</th><td>{cpu}%</td></tr>
-        <tr><th>Memory Usage</th><td>{mem.percent}%</td></tr>
+        <tr><th>Memory Usage</th><td>{mem_percent}%</td></tr>
         <tr><th>Uptime (sec)</th><td>{uptime}</td></tr>
-        <tr><th>Job Running</th><td>{"✅ Yes" if job_running else "❌ No"}</td></tr>
-        <tr><th>Status</th><td class="{ 'ok' if healthy else 'bad' }">{'Healthy' if healthy else 'High Load'}</td></tr>
+        <tr><th>Job Running</th><td>{running}</td></tr>
+        <tr><th>Status</th><td class="{health_class}">{health_label}</td></tr>
       </table>
     </body>
     </html>
     """
-    return html
+
+
+def ttl_cache(seconds):
+    """Cache a no-argument function's result for `seconds`."""
+    def decorator(fn):
+        cached = {"at": float("-inf"), "value": None}
+
+        @wraps(fn)
+        def wrapper():
+            now = time.monotonic()
+            if now - cached["at"] >= seconds:
+                cached["value"] = fn()
+                cached["at"] = now
+            return cached["value"]
+        return wrapper
+    return decorator
+
+
+@ttl_cache(0.5)
+def _system_load():
+    # non-blocking: CPU usage since the previous call
+    return psutil.cpu_percent(interval=None), psutil.virtual_memory().percent
+
+
+psutil.cpu_percent(interval=None)  # prime the baseline so the first reading is meaningful
+
+
+@app.route("/stats")
+def stats():
+    cpu, mem_percent = _system_load()
+    uptime = int(time.time() - current_job.start_time) if current_job.start_time else 0
+
+    inserted, total = current_job.inserted, current_job.total
+    progress = f"{(inserted/total*100):.2f}%" if total else "0%"
+    healthy = cpu < 80 and mem_percent < 80
+
+    return STATS_TEMPLATE.format_map({
+        "inserted": inserted,
+        "total": total,
+        "progress": progress,
+        "cpu": cpu,
+        "mem_percent": mem_percent,
+        "uptime": uptime,
+        "running": "✅ Yes" if current_job.running else "❌ No",
+        "health_class": "ok" if healthy else "bad",
+        "health_label": "Healthy" if healthy else "High Load",
+    })
 
 # -----------------------------
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000)
+    # local runs only; deployments use gunicorn (see app.yaml)
+    app.run(host="0.0.0.0", port=8000, threaded=True)
 
@@ -0,0 +1,44 @@
+import io
+import queue
+
+from pymongo import UpdateOne
+
+import etl_api_runner as etl
+
+
+def upsert(url_id, url):
+    return UpdateOne({"url_id": url_id}, {"$setOnInsert": {"input_url": url, "status": "pending"}}, upsert=True)
+
+
+def parse(data):
+    batches = queue.Queue()
+    etl._parse_batches(io.BytesIO(data), "test", batches, etl.JobStats(running=True))
+    return [op for ops in iter(batches.get, None) for op in ops]
+
+
+def test_three_field_first_row_keeps_later_rows(monkeypatch):
+    assert parse(b"1,a,x\n2,b\n3,c\n") == [upsert("1", "a"), upsert("2", "b"), upsert("3", "c")]
+
+
+def test_one_field_first_row_keeps_later_rows(monkeypatch):
+    assert parse(b"1\n2,b\n3,c\n") == [upsert("2", "b"), upsert("3", "c")]
+
+
+def test_ragged_rows_across_blocks(monkeypatch):
+    monkeypatch.setattr(etl, "PARSE_BLOCK_SIZE", 64)
+    data = b"".join(b"%d,u%d%s\n" % (n, n, b",extra" * (n % 3 == 0)) for n in range(200))
+    assert parse(data) == [upsert(str(n), f"u{n}") for n in range(200)]
+
+
+def test_ragged_row_keeps_first_occurrence_of_url_id(monkeypatch):
+    assert parse(b"X,a,extra\nX,b\n") == [upsert("X", "a")]
+
+
+def test_quoted_ragged_row_stays_in_file_order(monkeypatch):
+    assert parse(b'1,"a,b",z\n2,c\n') == [upsert("1", "a,b"), upsert("2", "c")]
+
+
+def test_ragged_rows_around_blank_lines_and_trailing_rows(monkeypatch):
+    data = b"1,a\n\n2,b,x\n3\n4,d\n\n5,e,y\n6,f,z\n"
+    assert parse(data) == [upsert("1", "a"), upsert("2", "b"), upsert("4", "d"),
+                                        upsert("5", "e"), upsert("6", "f")]